@@ -12,27 +12,125 @@
 
 
 #!/usr/bin/env python3
+import codecs
+import fcntl
+import json
+import logging
+import logging.handlers
 import os
 import pty
+import random
+import re
 import select
+import shlex
 import subprocess
 import sys
+import threading
+import time
 import pprint
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import SimpleQueue
+
+log = logging.getLogger('upload-internxt')
 
 failed_commands = {}
-filesdict = {}
-foldersdict = {}
+filesdict = {}  # ID cartella -> {nome file remoto: dimensione o None}, solo per le cartelle in lavorazione
+pending_uploads = {}  # ID cartella -> upload non ancora terminati
+foldersdict = {}  # (ID cartella padre, nome cartella) -> ID cartella
+_listed_ids = set()  # ID delle cartelle remote già listate
+_inflight = {}  # ID cartella -> Future dell'elenco avviato in anticipo
+lock = threading.Lock()
+# riga di `internxt list`: <file|folder> <nome, anche con spazi> <id>
+_LIST_RE = re.compile(r'^(file|folder)\s+(.+?)\s+(\S+)\s*$')
+# con --size-check: file <nome> <dimensione in byte> <id>
+_LIST_SIZE_RE = re.compile(r'^file\s+(.+?)\s+(\d+)\s+(\S+)\s*$')
+size_check = False
+# `internxt create-folder` riporta l'URL della nuova cartella: .../folder/<id>
+_FOLDER_ID_RE = re.compile(r'folder/(\S+)')
+# errore di create-folder per una cartella già presente (non "does not exist")
+_FOLDER_EXISTS_RE = re.compile(r'already exists|duplicate', re.IGNORECASE)
+RETRY_DELAY_CAP = 30.0  # attesa massima tra due tentativi, in secondi
+TOO_MANY_REQUESTS_RETRY = 5.0  # attesa minima dopo un errore di rate limit
+TOO_MANY_REQUESTS_MSG = b"too many requests"  # cercato, in minuscolo, nell'output della CLI
+executor = None
+folder_executor = None
+list_executor = None
+
+# Registro su disco dei caricamenti, per riprendere un'esecuzione interrotta
+JOURNAL_PATH = os.path.expanduser('~/.cache/internxt-upload/journal.jsonl')
+journal = None
+
+# Intestazione di retry.sh: riconosce lo script scritto da un'esecuzione precedente
+RETRY_HEADER = '#!/bin/sh\n# generato da upload-internxt.py\nset -e\n'
+uploaded_paths = {}  # (percorso locale assoluto, ID cartella remota) -> (dimensione, mtime)
+
+def load_journal():
+    journal.seek(0)
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # riga troncata da un'esecuzione interrotta
+            continue
+        if entry.get('status') == 'ok':
+            uploaded_paths[(entry['path'], entry['remote_id'])] = (entry.get('size'), entry.get('mtime'))
+
+def write_journal(entry):
+    with lock:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+
+def write_stdout(data):
+    # Scrive i byte direttamente sul descrittore di stdout, senza passare dal buffer di sys.stdout
+    view = memoryview(data)
+    try:
+        while view:
+            view = view[os.write(sys.stdout.fileno(), view):]
+    except BlockingIOError:
+        sys.stdout.buffer.write(view)
+        sys.stdout.buffer.flush()
 
 def run_command(command):
-    print(f'Running: {command}')
+    log.info('Running: %s', shlex.join(command))
+
+    # Il pty serve solo se la CLI rifiuta uno stdout non terminale
+    if os.environ.get("INTERNXT_FORCE_TTY") == "1":
+        return run_command_pty(command)
+
+    # Avvia il processo con l'output su una pipe
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+
+    # Leggi l'output a blocchi da 64 KB e giralo su stdout così com'è
+    sys.stdout.flush()
+    rate_limited = False
+    tail = b''
+    while True:
+        chunk = process.stdout.read1(65536)
+        if not chunk:
+            break
+        write_stdout(chunk)
+        # la coda del blocco precedente copre un messaggio spezzato tra due letture
+        if not rate_limited:
+            rate_limited = TOO_MANY_REQUESTS_MSG in (tail + chunk).lower()
+            tail = chunk[-len(TOO_MANY_REQUESTS_MSG):]
+    process.stdout.close()
+
+    # Attendi che il processo termini e restituisci il codice di uscita
+    # e se la CLI ha segnalato troppe richieste
+    return process.wait(), rate_limited
 
+def run_command_pty(command):
     # Crea un pseudo-terminale
     master, slave = pty.openpty()
 
     # Avvia il processo
     process = subprocess.Popen(
         command,
-        shell=True,
         stdout=slave,
         stderr=slave,
         close_fds=True
@@ -41,183 +139,507 @@ def run_command(command):
     # Chiudi il lato slave del pty nel processo padre
     os.close(slave)
 
+    # Un solo decoder per tutto l'output: i caratteri UTF-8 spezzati
+    # tra due letture vengono ricomposti invece di sollevare eccezioni
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    # Con il master non bloccante, a ogni risveglio di select
+    # si legge tutto l'output disponibile e lo si scrive in una volta
+    fcntl.fcntl(master, fcntl.F_SETFL, fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+
     # Leggi l'output
-    while True:
-        try:
-            # Attendi che ci sia output da leggere
-            rlist, _, _ = select.select([master], [], [])
-            if rlist:
-                output = os.read(master, 1024).decode()
-                if output:
-                    sys.stdout.write(output)
-                    sys.stdout.flush()
-                else:
-                    break
-        except OSError:
-            # Il processo figlio è terminato
-            break
+    eof = False
+    rate_limited = False
+    tail = b''
+    while not eof:
+        # Attendi che ci sia output da leggere
+        select.select([master], [], [])
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(master, 65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Il processo figlio è terminato
+                eof = True
+                break
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+        if chunks:
+            data = b''.join(chunks)
+            sys.stdout.write(decoder.decode(data))
+            sys.stdout.flush()
+            if not rate_limited:
+                rate_limited = TOO_MANY_REQUESTS_MSG in (tail + data).lower()
+                tail = data[-len(TOO_MANY_REQUESTS_MSG):]
+    sys.stdout.write(decoder.decode(b'', final=True))
 
     # Chiudi il lato master del pty
     os.close(master)
 
     # Attendi che il processo termini e restituisci il codice di uscita
-    return process.wait()
-
-def list_files_and_folders(folder_id):
-    destdir = ''
-    for key, value in foldersdict.items():
-        if value==folder_id:
-            destdir=key
+    # e se la CLI ha segnalato troppe richieste
+    return process.wait(), rate_limited
+
+def retry_sleep(attempt, attempts=3, base_delay=2.0, rate_limited=False):
+    # Backoff esponenziale limitato, con jitter, prima del tentativo successivo
+    if attempt < attempts - 1:
+        delay = min(RETRY_DELAY_CAP, base_delay * 2**attempt) * random.uniform(0.5, 1.5)
+        # se il server segnala troppe richieste non ha senso riprovare subito
+        if rate_limited:
+            delay = max(delay, TOO_MANY_REQUESTS_RETRY)
+        log.warning('Tentativo %s/%s fallito, riprovo tra %.1fs', attempt + 1, attempts, delay)
+        time.sleep(delay)
+
+def run_command_retry(command, attempts=3, base_delay=2.0):
+    for attempt in range(attempts):
+        return_code, rate_limited = run_command(command)
+        if return_code == 0:
             break
+        retry_sleep(attempt, attempts, base_delay, rate_limited)
+    return return_code
+
+def parse_list_line(line):
+    # Restituisce (tipo, nome, id, dimensione); la dimensione è None se non richiesta
+    if size_check:
+        m = _LIST_SIZE_RE.match(line)
+        if m:
+            obj_name, obj_size, obj_id = m.groups()
+            return 'file', obj_name, obj_id, int(obj_size)
+    m = _LIST_RE.match(line)
+    if m:
+        return m.groups() + (None,)
+    return None
 
-    command = f'internxt list --id={folder_id}'
-    print(command)
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate()
+def list_files_and_folders(folder_id):
+    # la cartella è già stata listata: filesdict e foldersdict sono aggiornati
+    if folder_id in _listed_ids:
+        return True
+
+    command = ['internxt', 'list', f'--id={folder_id}']
+    log.info('%s', shlex.join(command))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+    # stderr letto in un thread a parte, così la CLI non si blocca se la pipe si riempie
+    stderr_lines = []
+    stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr))
+    stderr_reader.start()
+
+    remote_files = {}
+    folders_count = 0
+    # Analizza l'elenco man mano che la CLI lo produce
+    for line in process.stdout:
+        parsed = parse_list_line(line)
+        if parsed:
+            obj_type, obj_name, obj_id, obj_size = parsed
+            if obj_type == "file":
+                remote_files[obj_name] = obj_size
+            elif obj_type == "folder":
+                folders_count += 1
+                with lock:
+                    foldersdict[(folder_id, obj_name)] = obj_id  # (ID padre, nome cartella) -> ID cartella
+    process.wait()
+    stderr_reader.join()
     if process.returncode != 0:
-        print(f"Errore nel listare i file: {stderr}", file=sys.stderr)
+        log.error("Errore nel listare i file: %s", ''.join(stderr_lines))
         return False
 
-    for line in stdout.splitlines():
-        parts = line.split()
-        if len(parts) >= 3:
-            obj_type = parts[0]
-            obj_id = parts[-1]
-            obj_name = ' '.join(parts[1:-1])
-            if obj_type == "file":
-                filesdict[f'{destdir}/{obj_name}'] = obj_id  # Nome file -> ID file
-            elif obj_type == "folder":
-                foldersdict[f'{destdir}/{obj_name}'] = obj_id  # Nome cartella -> ID cartella
-            #else:
-            #    print(filesdict)
-            #    print(foldersdict)
-            #    return False
-    print(filesdict)
+    with lock:
+        filesdict[folder_id] = remote_files
+        _listed_ids.add(folder_id)
+    log.info("Elencati %s file e %s cartelle in %s", len(remote_files), folders_count, folder_id)
     return True
 
 
 def upload_file(file_path, folder_id):
     # verifico se il file di destinazione esiste già
     # file_path
-    # <destdir>/path/file_path
-
-    for key, value in foldersdict.items():
-        print(f'key: {key} value: {value}')
-        if value==folder_id:
-            destdir=key
-            break;
+    # filesdict[folder_id] contiene nomi e dimensioni dei file remoti
+
+    journal_path = os.path.abspath(file_path)
+    command = ['internxt', 'upload', f'--id={folder_id}', f'--file={file_path}']
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        # file rimosso o rinominato dopo la scansione della cartella
+        log.error("File %s non accessibile: %s", file_path, e)
+        with lock:
+            failed_commands[shlex.join(command)] = str(e)
+        return
+    # salta solo se il file locale non è cambiato dal caricamento registrato
+    if uploaded_paths.get((journal_path, folder_id)) == (stat.st_size, stat.st_mtime_ns):
+        log.info("File %s già caricato in un'esecuzione precedente. Skip upload.", file_path)
+        return
 
-    file_name=os.path.basename(file_path)
-    file_dir=os.path.dirname(file_path)
-    destfile=destdir+'/'+file_name
+    # i percorsi arrivano da scandir con '/' come separatore
+    file_name=file_path[file_path.rfind('/')+1:]
+    # la CLI elenca i file senza estensione con un punto finale
     if "." not in file_name:
-        destfile+="."
+        file_name+="."
 
-    if destfile in filesdict.keys():
-        print(f"File {file_path} già presente. Skip upload.")
-        return
+    # -1: file non presente in remoto; None: presente, dimensione non richiesta
+    remote_size = filesdict.get(folder_id, {}).get(file_name, -1)
+    if remote_size != -1:
+        if remote_size is None or remote_size == stat.st_size:
+            log.info("File %s già presente. Skip upload.", file_path)
+            return
+        log.info("File %s già presente ma di %s byte, lo ricarico.", file_path, remote_size)
 
-    print(f"Copia oggetto {file_path} in {folder_id} ({destdir})")
+    log.info("Copia oggetto %s in %s", file_path, folder_id)
 
-    command = f'internxt upload --id={folder_id} --file="{file_path}"'
-    return_code = run_command(command)
+    return_code = run_command_retry(command)
     if return_code == 0:
-        print(f'File "{file_path}" caricato con successo.')
+        log.info('File "%s" caricato con successo.', file_path)
+        write_journal({"path": journal_path, "remote_id": folder_id, "status": "ok",
+                       "size": stat.st_size, "mtime": stat.st_mtime_ns})
     else:
-        print(f"Errore nel caricamento del file {file_path}.")
-        failed_commands[command] = "da ritornare errore upload"
+        log.error("Errore nel caricamento del file %s.", file_path)
+        with lock:
+            failed_commands[shlex.join(command)] = "da ritornare errore upload"
+        write_journal({"path": journal_path, "remote_id": folder_id, "status": "error", "command": shlex.join(command)})
 
 def create_folder(folder_name, parent_id):
     # verifica se la cartella esiste già
-    for key, value in foldersdict.items():
-        if parent_id==value:
-            destdir=key
-    print(f'creo {folder_name} in {parent_id} ({destdir})')
-    if destdir+'/'+folder_name in foldersdict.keys():
-        print(f'Cartella "{folder_name}" già presente. Skip creation.')
-        return foldersdict[destdir+'/'+folder_name]
-
-    command = f'internxt create-folder --id={parent_id} --name="{folder_name}"'
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate()
-    if process.returncode == 0 and "Folder" in stdout:
-        new_folder_id = stdout.split("folder/")[1].strip()
-        print(stdout.strip())
-        foldersdict[destdir+'/'+folder_name]=new_folder_id
+    log.info('creo %s in %s', folder_name, parent_id)
+    with lock:
+        existing_id = foldersdict.get((parent_id, folder_name))
+    if existing_id:
+        log.info('Cartella "%s" già presente. Skip creation.', folder_name)
+        return existing_id
+
+    command = ['internxt', 'create-folder', f'--id={parent_id}', f'--name={folder_name}']
+    for attempt in range(3):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        stdout, stderr = process.communicate()
+        m = _FOLDER_ID_RE.search(stdout) if process.returncode == 0 else None
+        if m:
+            break
+        # se la cartella esiste già riprovare non serve
+        if _FOLDER_EXISTS_RE.search(stderr):
+            break
+        retry_sleep(attempt, rate_limited=TOO_MANY_REQUESTS_MSG.decode() in stderr.lower())
+    if m:
+        new_folder_id = m.group(1)
+        log.info('%s', stdout.strip())
+        with lock:
+            foldersdict[(parent_id, folder_name)]=new_folder_id
         return new_folder_id
-    else:
-        print(f'Errore nella creazione della cartella "{folder_name}": {stderr}', file=sys.stderr)
-        failed_commands[command] = stderr
-        return None
 
-def process_folder(local_folder_path, dest_foolder_id):
-    print(f">>>>>>>process_folder su {local_folder_path} {dest_foolder_id}")
-    if not list_files_and_folders(dest_foolder_id):
-        print(f"Errore nel listare i file o le cartelle nella cartella con ID {dest_foolder_id}.")
-        return
-    else:
-        print(f'La kettura della cartella id {dest_foolder_id} non ha ritornato errori')
+    # Creata nel frattempo (es. da un tentativo andato in timeout):
+    # solo in questo caso si rilegge la cartella padre per recuperarne l'ID
+    if _FOLDER_EXISTS_RE.search(stderr):
+        with lock:
+            _listed_ids.discard(parent_id)
+        if list_files_and_folders(parent_id):
+            with lock:
+                existing_id = foldersdict.get((parent_id, folder_name))
+                # la rilettura ha ripopolato l'elenco dei file del padre:
+                # se i suoi upload sono già finiti non serve più tenerlo
+                if parent_id not in pending_uploads:
+                    filesdict.pop(parent_id, None)
+                    _listed_ids.discard(parent_id)
+            if existing_id:
+                log.info('Cartella "%s" già presente. Skip creation.', folder_name)
+                return existing_id
+
+    log.error('Errore nella creazione della cartella "%s": %s', folder_name, stderr)
+    with lock:
+        failed_commands[shlex.join(command)] = stderr
+    return None
+
+def prefetch_listing(folder_id):
+    # Avvia in background l'elenco di una cartella, una sola volta per ID
+    with lock:
+        if folder_id in _listed_ids or folder_id in _inflight:
+            return
+        _inflight[folder_id] = list_executor.submit(list_files_and_folders, folder_id)
+
+def wait_listing(folder_id):
+    # Usa l'elenco avviato in anticipo se c'è, altrimenti lo esegue ora
+    with lock:
+        future = _inflight.pop(folder_id, None)
+    if future is not None and future.result():
+        return True
+    return list_files_and_folders(folder_id)
+
+def upload_done(folder_id):
+    # Terminati gli upload di una cartella, il suo elenco di file non serve più
+    with lock:
+        remaining = pending_uploads[folder_id] - 1
+        if remaining:
+            pending_uploads[folder_id] = remaining
+        else:
+            del pending_uploads[folder_id]
+            filesdict.pop(folder_id, None)
+            _listed_ids.discard(folder_id)
 
-    for item in os.listdir(local_folder_path):
-        item_path=os.path.join(local_folder_path, item)
-
-        if os.path.isfile(item_path):
-             #print(f'upload_file({item_path},{dest_foolder_id})')
-             upload_file(item_path, dest_foolder_id)
-
-        # Crea la sottocartella e processala ricorsivamente
-        if os.path.isdir(item_path):
-            new_folder_id = create_folder(item, dest_foolder_id)
-            if new_folder_id:
-                    print(f"process_folder: {local_folder_path}/{item}, {new_folder_id}")
-                    process_folder(local_folder_path+'/'+item, new_folder_id)
-        print(f"esco da process_folder {local_folder_path}<<<<<<<<<<")
+def process_folder(local_folder_path, dest_foolder_id):
+    # Visita in ampiezza: i caricamenti di cartelle diverse procedono insieme nel pool.
+    # In coda c'è il future con l'ID della cartella remota, che può essere ancora in creazione.
+    root_future = Future()
+    root_future.set_result(dest_foolder_id)
+    queue = deque([(local_folder_path, root_future)])
+    futures = []
+    while queue:
+        local_folder_path, folder_future = queue.popleft()
+
+        # scandir riusa il tipo restituito da readdir: niente stat per ogni voce.
+        # La scansione avviene mentre la cartella remota viene creata.
+        with os.scandir(local_folder_path) as it:
+            entries = list(it)
+
+        dest_foolder_id = folder_future.result()
+        if not dest_foolder_id:
+            continue
+        log.info(">>>>>>>process_folder su %s %s", local_folder_path, dest_foolder_id)
+        if not wait_listing(dest_foolder_id):
+            log.error("Errore nel listare i file o le cartelle nella cartella con ID %s.", dest_foolder_id)
+            continue
+        else:
+            log.info('La kettura della cartella id %s non ha ritornato errori', dest_foolder_id)
+
+        # Le sottocartelle già presenti in remoto si elencano in background, in parallelo:
+        # quando usciranno dalla coda il loro elenco sarà pronto o in arrivo
+        with lock:
+            subfolder_ids = [foldersdict.get((dest_foolder_id, entry.name)) for entry in entries if entry.is_dir(follow_symlinks=False)]
+        for subfolder_id in subfolder_ids:
+            if subfolder_id:
+                prefetch_listing(subfolder_id)
+
+        # la voce in più tiene vivo l'elenco finché la scansione non è finita
+        with lock:
+            pending_uploads[dest_foolder_id] = pending_uploads.get(dest_foolder_id, 0) + 1
+
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                with lock:
+                    pending_uploads[dest_foolder_id] += 1
+                future = executor.submit(upload_file, entry.path, dest_foolder_id)
+                future.add_done_callback(lambda f, folder_id=dest_foolder_id: upload_done(folder_id))
+                futures.append((entry.path, dest_foolder_id, future))
+            elif entry.is_dir(follow_symlinks=False):
+                # Crea la sottocartella in background e mettila in coda
+                queue.append((entry.path, folder_executor.submit(create_folder, entry.name, dest_foolder_id)))
+        upload_done(dest_foolder_id)
+        log.info("esco da process_folder %s<<<<<<<<<<", local_folder_path)
+
+    # Attendi la fine di tutti i caricamenti: un errore imprevisto su un file
+    # conta come un caricamento fallito e non interrompe gli altri
+    for file_path, folder_id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            log.exception("Errore imprevisto nel caricamento del file %s.", file_path)
+            with lock:
+                failed_commands[shlex.join(['internxt', 'upload', f'--id={folder_id}', f'--file={file_path}'])] = str(e)
 
 def main():
-    if len(sys.argv) != 3:
-        print("Uso: python upload-internxt.py <file/cartella> <folder_id>")
+    global size_check
+    args = sys.argv[1:]
+    # --size-check: ricarica i file presenti con dimensione diversa da quella locale
+    size_check = '--size-check' in args
+    if size_check:
+        args.remove('--size-check')
+    # --reset-journal: dimentica i caricamenti registrati dalle esecuzioni precedenti
+    reset_journal = '--reset-journal' in args
+    if reset_journal:
+        args.remove('--reset-journal')
+    if len(args) != 2:
+        print("Uso: python upload-internxt.py [--size-check] [--reset-journal] <file/cartella> <folder_id>")
         return
 
-    path = sys.argv[1]
-    folder_id = sys.argv[2]
-    foldersdict['<destfolder>']=folder_id
+    path = args[0]
+    folder_id = args[1]
 
     if not os.path.exists(path):
         print(f"Il percorso {path} non esiste.")
         return
 
-    if os.path.isdir(path):
-        process_folder(path, folder_id)
-    else:
-        print(f"{path} non è una cartella valida.")
+    # I thread accodano i messaggi di log, un solo thread li scrive su stderr
+    log_queue = SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+    log_listener.start()
+
+    global executor, folder_executor, list_executor, journal
+    # Numero massimo di upload contemporanei
+    executor = ThreadPoolExecutor(max_workers=int(os.environ.get("INTERNXT_PARALLEL", "4")))
+    # Le cartelle si creano una alla volta, ma in parallelo alla scansione locale
+    folder_executor = ThreadPoolExecutor(max_workers=1)
+    # Chiamate `internxt list` contemporanee per le cartelle già esistenti
+    list_executor = ThreadPoolExecutor(max_workers=8)
+
+    # Il lock sul registro serializza esecuzioni concorrenti dello script
+    os.makedirs(os.path.dirname(JOURNAL_PATH), exist_ok=True)
+    journal = open(JOURNAL_PATH, 'a+')
+    try:
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.warning('Registro %s in uso da un\'altra esecuzione, attendo...', JOURNAL_PATH)
+        fcntl.flock(journal, fcntl.LOCK_EX)
+    if reset_journal:
+        journal.truncate(0)
+    load_journal()
+    if uploaded_paths:
+        log.info('Registro %s: %s file già caricati verranno saltati (--reset-journal per ricaricarli)',
+                 JOURNAL_PATH, len(uploaded_paths))
+
+    completed = False
+    try:
+        if os.path.isdir(path):
+            process_folder(path, folder_id)
+        else:
+            print(f"{path} non è una cartella valida.")
+        completed = True
+    finally:
+        # Se interrotto (es. Ctrl-C) annulla il lavoro ancora in coda invece di eseguirlo
+        executor.shutdown(wait=True, cancel_futures=not completed)
+        folder_executor.shutdown(wait=True, cancel_futures=not completed)
+        list_executor.shutdown(wait=True, cancel_futures=not completed)
+        journal.close()
+        log_listener.stop()
 
     print('Elenco domandi falliti')
     for key in failed_commands:
         print(key)
 
+    # Salva i comandi falliti in uno script, per ripeterli con `sh retry.sh`
+    if failed_commands:
+        script = RETRY_HEADER + ''.join(key + '\n' for key in failed_commands)
+        with open('retry.sh', 'w') as f:
+            f.write(script)
+        os.chmod('retry.sh', 0o755)
+        print('Comandi falliti salvati in retry.sh')
+    else:
+        # nessun errore: lo script di un'esecuzione precedente non serve più,
+        # ma si rimuove solo se l'ha scritto questo script
+        try:
+            with open('retry.sh') as f:
+                ours = f.read(len(RETRY_HEADER)) == RETRY_HEADER
+        except OSError:
+            ours = False
+        if ours:
+            os.remove('retry.sh')
+
 if __name__ == "__main__":
     main()
 #!/usr/bin/env python3
+import codecs
+import fcntl
+import json
+import logging
+import logging.handlers
 import os
 import pty
+import random
+import re
 import select
+import shlex
 import subprocess
 import sys
+import threading
+import time
 import pprint
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import SimpleQueue
+
+log = logging.getLogger('upload-internxt')
 
 failed_commands = {}
 folder_names = {}
+lock = threading.Lock()
+# riga di `internxt list`: <file|folder> <nome, anche con spazi> <id>
+_LIST_RE = re.compile(r'^(file|folder)\s+(.+?)\s+(\S+)\s*$')
+# con --size-check: file <nome> <dimensione in byte> <id>
+_LIST_SIZE_RE = re.compile(r'^file\s+(.+?)\s+(\d+)\s+(\S+)\s*$')
+size_check = False
+# `internxt create-folder` riporta l'URL della nuova cartella: .../folder/<id>
+_FOLDER_ID_RE = re.compile(r'folder/(\S+)')
+# errore di create-folder per una cartella già presente (non "does not exist")
+_FOLDER_EXISTS_RE = re.compile(r'already exists|duplicate', re.IGNORECASE)
+RETRY_DELAY_CAP = 30.0  # attesa massima tra due tentativi, in secondi
+TOO_MANY_REQUESTS_RETRY = 5.0  # attesa minima dopo un errore di rate limit
+TOO_MANY_REQUESTS_MSG = b"too many requests"  # cercato, in minuscolo, nell'output della CLI
+executor = None
+folder_executor = None
+
+# Registro su disco dei caricamenti, per riprendere un'esecuzione interrotta
+JOURNAL_PATH = os.path.expanduser('~/.cache/internxt-upload/journal.jsonl')
+journal = None
+
+# Intestazione di retry.sh: riconosce lo script scritto da un'esecuzione precedente
+RETRY_HEADER = '#!/bin/sh\n# generato da upload-internxt.py\nset -e\n'
+uploaded_paths = {}  # (percorso locale assoluto, ID cartella remota) -> (dimensione, mtime)
+
+def load_journal():
+    journal.seek(0)
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # riga troncata da un'esecuzione interrotta
+            continue
+        if entry.get('status') == 'ok':
+            uploaded_paths[(entry['path'], entry['remote_id'])] = (entry.get('size'), entry.get('mtime'))
+
+def write_journal(entry):
+    with lock:
+        journal.write(json.dumps(entry) + '\n')
+        journal.flush()
+
+def write_stdout(data):
+    # Scrive i byte direttamente sul descrittore di stdout, senza passare dal buffer di sys.stdout
+    view = memoryview(data)
+    try:
+        while view:
+            view = view[os.write(sys.stdout.fileno(), view):]
+    except BlockingIOError:
+        sys.stdout.buffer.write(view)
+        sys.stdout.buffer.flush()
 
 def run_command(command):
-    print(f'Running: {command}')
+    log.info('Running: %s', shlex.join(command))
+
+    # Il pty serve solo se la CLI rifiuta uno stdout non terminale
+    if os.environ.get("INTERNXT_FORCE_TTY") == "1":
+        return run_command_pty(command)
+
+    # Avvia il processo con l'output su una pipe
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT
+    )
+
+    # Leggi l'output a blocchi da 64 KB e giralo su stdout così com'è
+    sys.stdout.flush()
+    rate_limited = False
+    tail = b''
+    while True:
+        chunk = process.stdout.read1(65536)
+        if not chunk:
+            break
+        write_stdout(chunk)
+        # la coda del blocco precedente copre un messaggio spezzato tra due letture
+        if not rate_limited:
+            rate_limited = TOO_MANY_REQUESTS_MSG in (tail + chunk).lower()
+            tail = chunk[-len(TOO_MANY_REQUESTS_MSG):]
+    process.stdout.close()
 
+    # Attendi che il processo termini e restituisci il codice di uscita
+    # e se la CLI ha segnalato troppe richieste
+    return process.wait(), rate_limited
+
+def run_command_pty(command):
     # Crea un pseudo-terminale
     master, slave = pty.openpty()
 
     # Avvia il processo
     process = subprocess.Popen(
         command,
-        shell=True,
         stdout=slave,
         stderr=slave,
         close_fds=True
@@ -226,130 +648,317 @@ def run_command(command):
     # Chiudi il lato slave del pty nel processo padre
     os.close(slave)
 
+    # Un solo decoder per tutto l'output: i caratteri UTF-8 spezzati
+    # tra due letture vengono ricomposti invece di sollevare eccezioni
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    # Con il master non bloccante, a ogni risveglio di select
+    # si legge tutto l'output disponibile e lo si scrive in una volta
+    fcntl.fcntl(master, fcntl.F_SETFL, fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+
     # Leggi l'output
-    while True:
-        try:
-            # Attendi che ci sia output da leggere
-            rlist, _, _ = select.select([master], [], [])
-            if rlist:
-                output = os.read(master, 1024).decode()
-                if output:
-                    sys.stdout.write(output)
-                    sys.stdout.flush()
-                else:
-                    break
-        except OSError:
-            # Il processo figlio è terminato
-            break
+    eof = False
+    rate_limited = False
+    tail = b''
+    while not eof:
+        # Attendi che ci sia output da leggere
+        select.select([master], [], [])
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(master, 65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Il processo figlio è terminato
+                eof = True
+                break
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+        if chunks:
+            data = b''.join(chunks)
+            sys.stdout.write(decoder.decode(data))
+            sys.stdout.flush()
+            if not rate_limited:
+                rate_limited = TOO_MANY_REQUESTS_MSG in (tail + data).lower()
+                tail = data[-len(TOO_MANY_REQUESTS_MSG):]
+    sys.stdout.write(decoder.decode(b'', final=True))
 
     # Chiudi il lato master del pty
     os.close(master)
 
     # Attendi che il processo termini e restituisci il codice di uscita
-    return process.wait()
+    # e se la CLI ha segnalato troppe richieste
+    return process.wait(), rate_limited
+
+def retry_sleep(attempt, attempts=3, base_delay=2.0, rate_limited=False):
+    # Backoff esponenziale limitato, con jitter, prima del tentativo successivo
+    if attempt < attempts - 1:
+        delay = min(RETRY_DELAY_CAP, base_delay * 2**attempt) * random.uniform(0.5, 1.5)
+        # se il server segnala troppe richieste non ha senso riprovare subito
+        if rate_limited:
+            delay = max(delay, TOO_MANY_REQUESTS_RETRY)
+        log.warning('Tentativo %s/%s fallito, riprovo tra %.1fs', attempt + 1, attempts, delay)
+        time.sleep(delay)
+
+def run_command_retry(command, attempts=3, base_delay=2.0):
+    for attempt in range(attempts):
+        return_code, rate_limited = run_command(command)
+        if return_code == 0:
+            break
+        retry_sleep(attempt, attempts, base_delay, rate_limited)
+    return return_code
+
+def parse_list_line(line):
+    # Restituisce (tipo, nome, id, dimensione); la dimensione è None se non richiesta
+    if size_check:
+        m = _LIST_SIZE_RE.match(line)
+        if m:
+            obj_name, obj_size, obj_id = m.groups()
+            return 'file', obj_name, obj_id, int(obj_size)
+    m = _LIST_RE.match(line)
+    if m:
+        return m.groups() + (None,)
+    return None
 
 def list_files_and_folders(folder_id):
-    command = f'internxt list --id={folder_id}'
-    print(command)
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate()
-    if process.returncode != 0:
-        print(f"Errore nel listare i file: {stderr}", file=sys.stderr)
-        return None
+    command = ['internxt', 'list', f'--id={folder_id}']
+    log.info('%s', shlex.join(command))
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1)
+    # stderr letto in un thread a parte, così la CLI non si blocca se la pipe si riempie
+    stderr_lines = []
+    stderr_reader = threading.Thread(target=lambda: stderr_lines.extend(process.stderr))
+    stderr_reader.start()
 
     files = {}
     folders = {}
 
-    for line in stdout.splitlines():
-        parts = line.split()
-        if len(parts) >= 3:
-            obj_type = parts[0]
-            obj_id = parts[-1]
-            obj_name = ' '.join(parts[1:-1])
+    # Analizza l'elenco man mano che la CLI lo produce
+    for line in process.stdout:
+        parsed = parse_list_line(line)
+        if parsed:
+            obj_type, obj_name, obj_id, obj_size = parsed
             if obj_type == "file":
-                files[obj_name] = obj_id  # Nome file -> ID file
+                files[obj_name] = (obj_id, obj_size)  # Nome file -> (ID file, dimensione)
             elif obj_type == "folder":
                 folders[obj_name] = obj_id  # Nome cartella -> ID cartella
-                print(f'folder_names[{obj_id}]={obj_name}')
-                folder_names[obj_id] = obj_name  # ID cartella -> Nome cartella
-    #pprint.pprint(folder_names)
+                with lock:
+                    folder_names[obj_id] = obj_name  # ID cartella -> Nome cartella
+    process.wait()
+    stderr_reader.join()
+    if process.returncode != 0:
+        log.error("Errore nel listare i file: %s", ''.join(stderr_lines))
+        return None
+
+    log.info("Elencati %s file e %s cartelle in %s", len(files), len(folders), folder_id)
     return files, folders, folder_names
 
 
 def upload_file(file_path, folder_path, folder_id, existing_files, folder_names):
-    file_name = os.path.basename(file_path)
-    if file_name in existing_files:
-        print(f"File {file_name} già presente. Skip upload.")
+    journal_path = os.path.abspath(file_path)
+    command = ['internxt', 'upload', f'--id={folder_id}', f'--file={file_path}']
+    try:
+        stat = os.stat(file_path)
+    except OSError as e:
+        # file rimosso o rinominato dopo la scansione della cartella
+        log.error("File %s non accessibile: %s", file_path, e)
+        with lock:
+            failed_commands[shlex.join(command)] = str(e)
+        return
+    # salta solo se il file locale non è cambiato dal caricamento registrato
+    if uploaded_paths.get((journal_path, folder_id)) == (stat.st_size, stat.st_mtime_ns):
+        log.info("File %s già caricato in un'esecuzione precedente. Skip upload.", file_path)
         return
 
-    remote_folder_name = folder_names.get(folder_id, 'sconosciuta')
-    print(f"Copia oggetto {file_path} in {folder_id} ({folder_path})")
+    file_name = os.path.basename(file_path)
+    remote_file = existing_files.get(file_name)
+    if remote_file:
+        remote_size = remote_file[1]
+        if remote_size is None or remote_size == stat.st_size:
+            log.info("File %s già presente. Skip upload.", file_name)
+            return
+        log.info("File %s già presente ma di %s byte, lo ricarico.", file_name, remote_size)
 
-    command = f'internxt upload --id={folder_id} --file="{file_path}"'
-    return_code = run_command(command)
+    log.info("Copia oggetto %s in %s (%s)", file_path, folder_id, folder_path)
+
+    return_code = run_command_retry(command)
     if return_code == 0:
-        print(f'File "{file_path}" caricato con successo.')
+        log.info('File "%s" caricato con successo.', file_path)
+        write_journal({"path": journal_path, "remote_id": folder_id, "status": "ok",
+                       "size": stat.st_size, "mtime": stat.st_mtime_ns})
     else:
-        print(f"Errore nel caricamento del file {file_path}.")
-        failed_commands[command] = "da ritornare errore upload"
+        log.error("Errore nel caricamento del file %s.", file_path)
+        with lock:
+            failed_commands[shlex.join(command)] = "da ritornare errore upload"
+        write_journal({"path": journal_path, "remote_id": folder_id, "status": "error", "command": shlex.join(command)})
 
 def create_folder(folder_name, parent_id, existing_folders):
-    if folder_name in existing_folders:
-        print(f'Cartella "{folder_name}" già presente. Skip creation.')
-        return existing_folders[folder_name]
-
-    command = f'internxt create-folder --id={parent_id} --name="{folder_name}"'
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    stdout, stderr = process.communicate()
-    if process.returncode == 0 and "Folder" in stdout:
-        new_folder_id = stdout.split("folder/")[1].strip()
-        folder_names[new_folder_id] = folder_name  # Aggiorna qui il folder_names
-        print(stdout.strip())
+    existing_id = existing_folders.get(folder_name)
+    if existing_id:
+        log.info('Cartella "%s" già presente. Skip creation.', folder_name)
+        return existing_id
+
+    command = ['internxt', 'create-folder', f'--id={parent_id}', f'--name={folder_name}']
+    for attempt in range(3):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        stdout, stderr = process.communicate()
+        m = _FOLDER_ID_RE.search(stdout) if process.returncode == 0 else None
+        if m:
+            break
+        # se la cartella esiste già riprovare non serve
+        if _FOLDER_EXISTS_RE.search(stderr):
+            break
+        retry_sleep(attempt, rate_limited=TOO_MANY_REQUESTS_MSG.decode() in stderr.lower())
+    if m:
+        new_folder_id = m.group(1)
+        with lock:
+            folder_names[new_folder_id] = folder_name  # Aggiorna qui il folder_names
+        log.info('%s', stdout.strip())
         return new_folder_id
-    else:
-        print(f'Errore nella creazione della cartella "{folder_name}": {stderr}', file=sys.stderr)
-        failed_commands[command] = stderr
-        return None
 
-def process_folder(folder_path, parent_id):
-    existing_files, existing_folders, folder_names = list_files_and_folders(parent_id)
-    if existing_files is None or existing_folders is None:
-        print(f"Errore nel listare i file o le cartelle nella cartella con ID {parent_id}.")
-        return
-
-    for root, dirs, files in os.walk(folder_path):
-        # Carica tutti i file nella cartella corrente
-        for file in files:
-            file_path = os.path.join(root, file)
-            upload_file(file_path, folder_path, parent_id, existing_files, folder_names)
+    # Creata nel frattempo (es. da un tentativo andato in timeout):
+    # solo in questo caso si rilegge la cartella padre per recuperarne l'ID
+    if _FOLDER_EXISTS_RE.search(stderr):
+        listing = list_files_and_folders(parent_id)
+        if listing:
+            existing_id = listing[1].get(folder_name)
+            if existing_id:
+                log.info('Cartella "%s" già presente. Skip creation.', folder_name)
+                return existing_id
+
+    log.error('Errore nella creazione della cartella "%s": %s', folder_name, stderr)
+    with lock:
+        failed_commands[shlex.join(command)] = stderr
+    return None
 
-        # Crea tutte le sottocartelle e processale ricorsivamente
-        for dir in dirs:
-            dir_path = os.path.join(root, dir)
-            new_folder_id = create_folder(dir, parent_id, existing_folders)
-            if new_folder_id:
-                process_folder(dir_path, new_folder_id)
+def process_folder(folder_path, parent_id):
+    # Visita in ampiezza: i caricamenti di cartelle diverse procedono insieme nel pool.
+    # In coda c'è il future con l'ID della cartella remota, che può essere ancora in creazione.
+    root_future = Future()
+    root_future.set_result(parent_id)
+    queue = deque([(folder_path, root_future)])
+    futures = []
+    while queue:
+        folder_path, folder_future = queue.popleft()
+
+        # La scansione locale avviene mentre la cartella remota viene creata
+        with os.scandir(folder_path) as it:
+            entries = list(it)
+
+        parent_id = folder_future.result()
+        if not parent_id:
+            continue
+        listing = list_files_and_folders(parent_id)
+        if listing is None:
+            log.error("Errore nel listare i file o le cartelle nella cartella con ID %s.", parent_id)
+            continue
+        existing_files, existing_folders, folder_names = listing
+
+        for entry in entries:
+            # Carica i file della cartella corrente
+            if entry.is_file(follow_symlinks=False):
+                future = executor.submit(upload_file, entry.path, folder_path, parent_id, existing_files, folder_names)
+                futures.append((entry.path, parent_id, future))
+            # Crea le sottocartelle in background e mettile in coda
+            elif entry.is_dir(follow_symlinks=False):
+                queue.append((entry.path, folder_executor.submit(create_folder, entry.name, parent_id, existing_folders)))
+
+    # Attendi la fine di tutti i caricamenti: un errore imprevisto su un file
+    # conta come un caricamento fallito e non interrompe gli altri
+    for file_path, folder_id, future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            log.exception("Errore imprevisto nel caricamento del file %s.", file_path)
+            with lock:
+                failed_commands[shlex.join(['internxt', 'upload', f'--id={folder_id}', f'--file={file_path}'])] = str(e)
 
 def main():
-    if len(sys.argv) != 3:
-        print("Uso: python upload-internxt.py <file/cartella> <folder_id>")
+    global size_check
+    args = sys.argv[1:]
+    # --size-check: ricarica i file presenti con dimensione diversa da quella locale
+    size_check = '--size-check' in args
+    if size_check:
+        args.remove('--size-check')
+    # --reset-journal: dimentica i caricamenti registrati dalle esecuzioni precedenti
+    reset_journal = '--reset-journal' in args
+    if reset_journal:
+        args.remove('--reset-journal')
+    if len(args) != 2:
+        print("Uso: python upload-internxt.py [--size-check] [--reset-journal] <file/cartella> <folder_id>")
         return
 
-    path = sys.argv[1]
-    folder_id = sys.argv[2]
+    path = args[0]
+    folder_id = args[1]
 
     if not os.path.exists(path):
         print(f"Il percorso {path} non esiste.")
         return
 
-    if os.path.isdir(path):
-        process_folder(path, folder_id)
-    else:
-        print(f"{path} non è una cartella valida.")
+    # I thread accodano i messaggi di log, un solo thread li scrive su stderr
+    log_queue = SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[logging.handlers.QueueHandler(log_queue)], force=True)
+    log_listener.start()
+
+    global executor, folder_executor, journal
+    # Numero massimo di upload contemporanei
+    executor = ThreadPoolExecutor(max_workers=int(os.environ.get("INTERNXT_PARALLEL", "4")))
+    # Le cartelle si creano una alla volta, ma in parallelo alla scansione locale
+    folder_executor = ThreadPoolExecutor(max_workers=1)
+
+    # Il lock sul registro serializza esecuzioni concorrenti dello script
+    os.makedirs(os.path.dirname(JOURNAL_PATH), exist_ok=True)
+    journal = open(JOURNAL_PATH, 'a+')
+    try:
+        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.warning('Registro %s in uso da un\'altra esecuzione, attendo...', JOURNAL_PATH)
+        fcntl.flock(journal, fcntl.LOCK_EX)
+    if reset_journal:
+        journal.truncate(0)
+    load_journal()
+    if uploaded_paths:
+        log.info('Registro %s: %s file già caricati verranno saltati (--reset-journal per ricaricarli)',
+                 JOURNAL_PATH, len(uploaded_paths))
+
+    completed = False
+    try:
+        if os.path.isdir(path):
+            process_folder(path, folder_id)
+        else:
+            print(f"{path} non è una cartella valida.")
+        completed = True
+    finally:
+        # Se interrotto (es. Ctrl-C) annulla il lavoro ancora in coda invece di eseguirlo
+        executor.shutdown(wait=True, cancel_futures=not completed)
+        folder_executor.shutdown(wait=True, cancel_futures=not completed)
+        journal.close()
+        log_listener.stop()
 
     print('Elenco domandi falliti')
     for key in failed_commands:
         print(key)
 
+    # Salva i comandi falliti in uno script, per ripeterli con `sh retry.sh`
+    if failed_commands:
+        script = RETRY_HEADER + ''.join(key + '\n' for key in failed_commands)
+        with open('retry.sh', 'w') as f:
+            f.write(script)
+        os.chmod('retry.sh', 0o755)
+        print('Comandi falliti salvati in retry.sh')
+    else:
+        # nessun errore: lo script di un'esecuzione precedente non serve più,
+        # ma si rimuove solo se l'ha scritto questo script
+        try:
+            with open('retry.sh') as f:
+                ours = f.read(len(RETRY_HEADER)) == RETRY_HEADER
+        except OSError:
+            ours = False
+        if ours:
+            os.remove('retry.sh')
+
 if __name__ == "__main__":
     main()